@@ -0,0 +1,202 @@
+# app/backup.py
+import gzip
+import os
+import sqlite3
+import tempfile
+import zlib
+from pathlib import Path
+
+from app import crud, db
+
+# Size of the chunks read, compressed and streamed
+CHUNK_SIZE = 64 * 1024
+
+# Tables a snapshot must contain to be restored
+REQUIRED_TABLES = ("nodes", "users")
+
+# First bytes of an uncompressed SQLite database file
+_SQLITE_MAGIC = b"SQLite format 3\x00"
+
+
+def _temp_db():
+    """
+    Creates an empty temporary file next to the live database.
+    Keeping it on the same volume avoids filling a small /tmp with large snapshots.
+    Returns:
+        str : Path of the temporary file.
+    """
+    parent = Path(db.DB_PATH).parent
+    parent.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".db", prefix=".wg-backup-", dir=parent)
+    os.close(fd)
+    return path
+
+
+def _copy(src, dst):
+    """
+    Copies a database into another one with the SQLite online backup API, in a single step.
+    A stepped copy restarts from the first page whenever another connection writes,
+    and never ends under a steady write load. In WAL mode, a single step reads one
+    consistent snapshot of the source without blocking its writers.
+    Arguments:
+        src : Source SQLite connection.
+        dst : Destination SQLite connection.
+    """
+    src.backup(dst)
+
+
+def snapshot(dest_path):
+    """
+    Writes a consistent copy of the live database to dest_path.
+    Arguments:
+        dest_path : Path of the (uncompressed) snapshot file.
+    """
+    src = crud.get_conn()
+    dst = sqlite3.connect(dest_path)
+    try:
+        _copy(src, dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def iter_backup():
+    """
+    Takes a snapshot of the live database and yields it gzip-compressed, chunk by chunk.
+    Only one chunk is held in memory at a time, whatever the size of the database.
+    Yields:
+        bytes : Chunks of the gzip-compressed snapshot.
+    """
+    path = _temp_db()
+    try:
+        snapshot(path)
+        comp = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = comp.compress(chunk)
+                if data:
+                    yield data
+        yield comp.flush()
+    finally:
+        os.unlink(path)
+
+
+def write_backup(out_path):
+    """
+    Writes a gzip-compressed snapshot of the live database to out_path.
+    Arguments:
+        out_path : Path of the backup file.
+    """
+    with open(out_path, "wb") as f:
+        for chunk in iter_backup():
+            f.write(chunk)
+
+
+def _check_snapshot(path):
+    """
+    Verifies that a file is a sound SQLite database holding the application tables,
+    that can be copied into the live database.
+    The live database runs in WAL mode, where the backup API cannot change the page size:
+    snapshots with another page size are rejected, as are snapshots from a newer schema.
+    Arguments:
+        path : Path of the uncompressed snapshot.
+    Raises:
+        ValueError : If the file is not a valid snapshot.
+    """
+    live = crud.get_conn()
+    try:
+        live_page_size = live.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        live.close()
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        res = conn.execute("PRAGMA integrity_check").fetchall()
+        if [r[0] for r in res] != ["ok"]:
+            raise ValueError("integrity check failed: " + "; ".join(r[0] for r in res[:5]))
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        missing = [t for t in REQUIRED_TABLES if t not in tables]
+        if missing:
+            raise ValueError("missing tables: " + ", ".join(missing))
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > db.SCHEMA_VERSION:
+            raise ValueError(f"schema version {version} is newer than this application ({db.SCHEMA_VERSION})")
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        if page_size != live_page_size:
+            raise ValueError(f"page size {page_size} differs from the live database ({live_page_size})")
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"not a SQLite database ({e})") from e
+    finally:
+        conn.close()
+
+
+def restore(fileobj):
+    """
+    Replaces the live database with a snapshot read from a binary file object.
+    Gzip-compressed and raw SQLite snapshots are both accepted.
+    The snapshot is written to a temporary file and checked before anything is replaced.
+    Arguments:
+        fileobj : Readable binary file object.
+    Raises:
+        ValueError : If the snapshot is invalid or cannot be copied
+                     (the live database is then left untouched).
+    """
+    path = _temp_db()
+    try:
+        head = fileobj.read(CHUNK_SIZE)
+        with open(path, "wb") as out:
+            if head[:2] == b"\x1f\x8b":
+                stream = gzip.GzipFile(fileobj=_Prefixed(head, fileobj))
+                try:
+                    while True:
+                        chunk = stream.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                except (OSError, EOFError, zlib.error) as e:
+                    raise ValueError(f"corrupted archive ({e})") from e
+            elif head.startswith(_SQLITE_MAGIC):
+                chunk = head
+                while chunk:
+                    out.write(chunk)
+                    chunk = fileobj.read(CHUNK_SIZE)
+            else:
+                raise ValueError("unknown backup format")
+
+        _check_snapshot(path)
+
+        src = sqlite3.connect(path)
+        dst = crud.get_conn()
+        try:
+            _copy(src, dst)
+        except sqlite3.Error as e:
+            raise ValueError(f"cannot copy the snapshot into the database ({e})") from e
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        os.unlink(path)
+
+    # Snapshots taken by older versions may lack the newest tables
+    crud.init_db()
+
+
+class _Prefixed:
+    """
+    Minimal read-only file object replaying already consumed bytes before the rest of a stream.
+    """
+
+    def __init__(self, head, fileobj):
+        self._head = head
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        if self._head:
+            if size is None or size < 0:
+                data, self._head = self._head + self._fileobj.read(), b""
+                return data
+            data, self._head = self._head[:size], self._head[size:]
+            return data
+        return self._fileobj.read(size)
@@ -1,80 +1,293 @@
-import sqlite3
-from pathlib import Path
-import os
-
-# Path to the database file, with a default value
-DB_FILE = os.environ.get("DB_FILE", "/data/wireguard.db")
-Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
-
-# Function to establish a SQLite connection
-def get_conn():
-    """
-    Creates and returns a connection to the SQLite database.
-    Configures row_factory to return query results as dictionaries.
-    """
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-# Function to initialize the database
-def init_db():
-    """
-    Initializes the SQLite database by creating the 'nodes' and 'users' tables if they don't exist.
-    """
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS nodes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE,
-        public_ip TEXT,
-        vpn_ip TEXT,
-        port INTEGER,
-        mtu INTEGER,
-        private_key TEXT,
-        public_key TEXT
-    )""")
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE,
-        vpn_ip TEXT,
-        mtu INTEGER,
-        private_key TEXT,
-        public_key TEXT
-    )""")
-    conn.commit()
-    conn.close()
+import ipaddress
+import re
 
+from app.db import DEFAULT_MESH_ID, get_conn, init_db, reset_db
+from app.events import publish
 
-# -------- Nodes ----------
-# Function to list all nodes
-def list_nodes():
+# Mesh names are used as directory names for the generated configs
+MESH_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,62}$")
+
+# Subnet used by meshes that do not define one
+DEFAULT_SUBNET = "10.100.10.0/24"
+
+
+def mesh_network(mesh):
+    """
+    Returns the VPN subnet of a mesh as an ipaddress network.
+    Meshes without a (valid) subnet use DEFAULT_SUBNET.
+    Arguments:
+        mesh : Mesh row.
+    Returns:
+        IPv4Network or IPv6Network : Subnet of the mesh.
+    """
+    try:
+        return ipaddress.ip_network(mesh["subnet"] or DEFAULT_SUBNET, strict=False)
+    except ValueError:
+        return ipaddress.ip_network(DEFAULT_SUBNET)
+
+def _check_vpn_ip(conn, mesh_id, vpn_ip):
+    """
+    Verifies that a VPN IP address is an address of the subnet of its mesh.
+    An empty value is accepted: a free address of the subnet is then assigned.
+    Arguments:
+        conn : SQLite connection.
+        mesh_id : ID of the mesh of the node or user.
+        vpn_ip : VPN IP address to check.
+    Raises:
+        ValueError : If the address is invalid or outside the subnet of the mesh.
+    """
+    if vpn_ip in (None, ""):
+        return
+    try:
+        addr = ipaddress.ip_address(vpn_ip)
+    except ValueError:
+        raise ValueError(f"Invalid VPN IP address: {vpn_ip!r}")
+    mesh = conn.execute("SELECT subnet FROM meshes WHERE id=?", (mesh_id,)).fetchone()
+    network = mesh_network(mesh or {"subnet": None})
+    if addr not in network:
+        raise ValueError(f"VPN IP address {vpn_ip} is outside the subnet {network} of its mesh")
+
+
+# -------- Meshes ----------
+# Function to list all meshes
+def list_meshes():
     conn = get_conn()
     rows = conn.execute("""
-        SELECT id,name,public_ip,vpn_ip,port,mtu,private_key,public_key
-        FROM nodes ORDER BY id ASC
+        SELECT id,name,subnet,default_port,default_mtu,output_dir
+        FROM meshes ORDER BY id ASC
     """).fetchall()
     conn.close()
     return rows
 
+# Function to get a mesh by its ID
+def get_mesh(mesh_id):
+    conn = get_conn()
+    row = conn.execute("""
+        SELECT id,name,subnet,default_port,default_mtu,output_dir
+        FROM meshes WHERE id=?
+    """, (mesh_id,)).fetchone()
+    conn.close()
+    return row
+
+# Function to get a mesh by its name
+def get_mesh_by_name(name):
+    conn = get_conn()
+    row = conn.execute("""
+        SELECT id,name,subnet,default_port,default_mtu,output_dir
+        FROM meshes WHERE name=?
+    """, (name,)).fetchone()
+    conn.close()
+    return row
+
+def _free_vpn_ips(conn, mesh_id):
+    """
+    Lists, in order, the addresses of the mesh subnet used by no node nor user of the mesh.
+    Arguments:
+        conn : SQLite connection.
+        mesh_id : ID of the mesh.
+    Returns:
+        iterator : Free ipaddress addresses (computed lazily).
+    """
+    mesh = conn.execute("SELECT subnet FROM meshes WHERE id=?", (mesh_id,)).fetchone()
+    network = mesh_network(mesh or {"subnet": None})
+    used = set()
+    for table in ("nodes", "users"):
+        for (vpn_ip,) in conn.execute(f"SELECT vpn_ip FROM {table} WHERE mesh_id=? AND vpn_ip IS NOT NULL",
+                                      (mesh_id,)):
+            try:
+                used.add(ipaddress.ip_address(vpn_ip))
+            except ValueError:
+                pass
+    return (a for a in network.hosts() if a not in used)
+
+def _assign_vpn_ips(conn, table, peer_ids, mesh_id):
+    """
+    Stores a free address of the mesh subnet as the VPN IP of each given peer, in order.
+    Must run inside a write transaction, so that two peers never get the same address.
+    Arguments:
+        conn : SQLite connection.
+        table : "nodes" or "users".
+        peer_ids : IDs of the peers without VPN IP.
+        mesh_id : ID of the mesh of the peers.
+    Raises:
+        ValueError : If the subnet has no free address left.
+    """
+    free = _free_vpn_ips(conn, mesh_id)
+    for peer_id in peer_ids:
+        addr = next(free, None)
+        if addr is None:
+            raise ValueError(f"No free VPN IP address left in the subnet of mesh {mesh_id}")
+        conn.execute(f"UPDATE {table} SET vpn_ip=? WHERE id=?", (str(addr), peer_id))
+
+def assign_missing_vpn_ips(mesh_id):
+    """
+    Gives the nodes, then the users, of a mesh that have no VPN IP a free address of the mesh subnet.
+    Addresses are stored, so a peer keeps the same address from one generation to the next.
+    Arguments:
+        mesh_id : ID of the mesh.
+    Raises:
+        ValueError : If the subnet has no free address left (nothing is then stored).
+    """
+    conn = get_conn()
+    assigned = {}
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for kind, table in PEER_TABLES.items():
+                ids = [r[0] for r in conn.execute(f"""
+                    SELECT id FROM {table} WHERE mesh_id=? AND (vpn_ip IS NULL OR vpn_ip='') ORDER BY id
+                """, (mesh_id,))]
+                _assign_vpn_ips(conn, table, ids, mesh_id)
+                assigned[kind] = ids
+    finally:
+        conn.close()
+    for kind, ids in assigned.items():
+        for peer_id in ids:
+            publish(kind, {"op": "updated", "id": peer_id})
+
+# Function to create a new mesh
+def create_mesh(name, subnet, default_port=51820, default_mtu=1420, output_dir=None):
+    """
+    Adds a new mesh (isolated WireGuard network) to the 'meshes' table.
+    Arguments:
+        name : Unique name of the mesh (letters, digits, '-' and '_').
+        subnet : VPN subnet of the mesh (e.g. 10.200.0.0/24).
+        default_port : Port used by nodes without an explicit port.
+        default_mtu : MTU used by nodes and users without an explicit MTU.
+        output_dir : Directory for the generated configs (default: one directory per mesh).
+    Returns:
+        int : ID of the new mesh.
+    Raises:
+        ValueError : If the name is not a valid mesh name or the subnet is not a valid network.
+    """
+    if not MESH_NAME_RE.match(name or ""):
+        raise ValueError(f"Invalid mesh name: {name!r}")
+    try:
+        subnet = str(ipaddress.ip_network(subnet or "", strict=False))
+    except ValueError:
+        raise ValueError(f"Invalid subnet: {subnet!r}")
+    conn = get_conn()
+    try:
+        with conn:
+            cur = conn.execute("""
+                INSERT INTO meshes(name, subnet, default_port, default_mtu, output_dir)
+                VALUES (?, ?, ?, ?, ?)
+            """, (name, subnet, default_port, default_mtu, output_dir or None))
+    finally:
+        conn.close()
+    publish("mesh", {"op": "added", "id": cur.lastrowid})
+    return cur.lastrowid
+
+# Function to delete a mesh with its nodes and users
+def delete_mesh(mesh_id):
+    """
+    Deletes a mesh, its nodes, its users and their key history.
+    Arguments:
+        mesh_id : ID of the mesh to delete.
+    Raises:
+        ValueError : If mesh_id is the default mesh.
+    """
+    if int(mesh_id) == DEFAULT_MESH_ID:
+        raise ValueError("The default mesh cannot be deleted")
+    conn = get_conn()
+    with conn:
+        for kind, table in PEER_TABLES.items():
+            conn.execute(f"""
+                DELETE FROM key_history WHERE kind=?
+                AND peer_id IN (SELECT id FROM {table} WHERE mesh_id=?)
+            """, (kind, mesh_id))
+            conn.execute(f"DELETE FROM {table} WHERE mesh_id=?", (mesh_id,))
+        conn.execute("DELETE FROM meshes WHERE id=?", (mesh_id,))
+    conn.close()
+    publish("mesh", {"op": "deleted", "id": int(mesh_id)})
+
+
+# -------- Nodes ----------
+# Columns returned for nodes; private keys are only read when generating configs
+NODE_COLUMNS = "id,name,public_ip,vpn_ip,port,mtu,public_key,mesh_id"
+
+# Function to list all nodes, optionally restricted to one mesh
+def list_nodes(mesh_id=None, with_private_keys=False):
+    """
+    Lists nodes ordered by ID.
+    Without private keys, a mesh listing is served by the covering index 'idx_nodes_list'.
+    Arguments:
+        mesh_id : Optional mesh to restrict the list to.
+        with_private_keys : Also return the 'private_key' column.
+    """
+    cols = NODE_COLUMNS + (",private_key" if with_private_keys else "")
+    conn = get_conn()
+    if mesh_id is None:
+        rows = conn.execute(f"SELECT {cols} FROM nodes ORDER BY id ASC").fetchall()
+    else:
+        rows = conn.execute(f"SELECT {cols} FROM nodes WHERE mesh_id=? ORDER BY id ASC", (mesh_id,)).fetchall()
+    conn.close()
+    return rows
+
+# Function to count the nodes of a mesh
+def count_nodes(mesh_id):
+    conn = get_conn()
+    n = conn.execute("SELECT COUNT(*) FROM nodes WHERE mesh_id=?", (mesh_id,)).fetchone()[0]
+    conn.close()
+    return n
+
+# Function to get a node by its ID
+def get_node(node_id):
+    conn = get_conn()
+    row = conn.execute(f"SELECT {NODE_COLUMNS} FROM nodes WHERE id=?", (node_id,)).fetchone()
+    conn.close()
+    return row
+
+# Function to get a node by its name
+def get_node_by_name(name, mesh_id=DEFAULT_MESH_ID):
+    conn = get_conn()
+    row = conn.execute(f"SELECT {NODE_COLUMNS} FROM nodes WHERE mesh_id=? AND name=?", (mesh_id, name)).fetchone()
+    conn.close()
+    return row
+
+# Function to get a node by its VPN IP
+def get_node_by_vpn_ip(vpn_ip, mesh_id=DEFAULT_MESH_ID):
+    conn = get_conn()
+    row = conn.execute(f"SELECT {NODE_COLUMNS} FROM nodes WHERE mesh_id=? AND vpn_ip=?", (mesh_id, vpn_ip)).fetchone()
+    conn.close()
+    return row
+
+# Function to get a node by its public key
+def get_node_by_public_key(public_key):
+    conn = get_conn()
+    row = conn.execute(f"SELECT {NODE_COLUMNS} FROM nodes WHERE public_key=?", (public_key,)).fetchone()
+    conn.close()
+    return row
+
 # Function to create a new node
-def create_node(name, public_ip, port, mtu, vpn_ip):
+def create_node(name, public_ip, port, mtu, vpn_ip, mesh_id=DEFAULT_MESH_ID):
     """
     Adds a new node to the 'nodes' table.
     Arguments:
-        name : Unique name of the node.
+        name : Name of the node, unique within its mesh.
         public_ip : Public IP address of the node.
         port : Port used by the node.
         mtu : Maximum Transmission Unit (MTU) of the node.
-        vpn_ip : VPN IP address of the node.
+        vpn_ip : VPN IP address of the node, inside the subnet of the mesh
+                 (default: first free address of the subnet).
+        mesh_id : ID of the mesh the node belongs to.
+    Raises:
+        ValueError : If vpn_ip is outside the subnet of the mesh, or the subnet is full.
     """
     conn = get_conn()
-    conn.execute("""
-        INSERT INTO nodes(name, public_ip, port, mtu, vpn_ip)
-        VALUES (?, ?, ?, ?, ?)
-    """, (name, public_ip, port, mtu, vpn_ip))
-    conn.commit(); conn.close()
+    try:
+        _check_vpn_ip(conn, mesh_id, vpn_ip)
+        # Roll back and release the lock if the name is already taken
+        with conn:
+            cur = conn.execute("""
+                INSERT INTO nodes(mesh_id, name, public_ip, port, mtu, vpn_ip)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (mesh_id, name, public_ip, port, mtu, vpn_ip))
+            if not vpn_ip:
+                _assign_vpn_ips(conn, "nodes", [cur.lastrowid], mesh_id)
+    finally:
+        conn.close()
+    publish("node", {"op": "added", "id": cur.lastrowid, "mesh_id": mesh_id})
 
 # Function to update the public IP of a node
 def update_node_public_ip(node_id, new_ip):
@@ -87,6 +300,7 @@ def update_node_public_ip(node_id, new_ip):
     conn = get_conn()
     conn.execute("UPDATE nodes SET public_ip=? WHERE id=?", (new_ip, node_id))
     conn.commit(); conn.close()
+    publish("node", {"op": "updated", "id": int(node_id)})
 
 # Function to update the VPN IP of a node
 def update_node_vpn_ip(node_id, new_vpn_ip):
@@ -94,38 +308,105 @@ def update_node_vpn_ip(node_id, new_vpn_ip):
     Updates the VPN IP address of an existing node.
     Arguments:
         node_id : ID of the node to update.
-        new_vpn_ip : New VPN IP address.
+        new_vpn_ip : New VPN IP address, inside the subnet of the mesh.
+    Raises:
+        ValueError : If new_vpn_ip is outside the subnet of the mesh.
     """
     conn = get_conn()
-    conn.execute("UPDATE nodes SET vpn_ip=? WHERE id=?", (new_vpn_ip, node_id))
-    conn.commit(); conn.close()
+    try:
+        row = conn.execute("SELECT mesh_id FROM nodes WHERE id=?", (node_id,)).fetchone()
+        if row:
+            _check_vpn_ip(conn, row["mesh_id"], new_vpn_ip)
+        conn.execute("UPDATE nodes SET vpn_ip=? WHERE id=?", (new_vpn_ip, node_id))
+        conn.commit()
+    finally:
+        conn.close()
+    publish("node", {"op": "updated", "id": int(node_id)})
 
 # -------- Users ----------
-# Function to list all users
-def list_users():
+# Columns returned for users; private keys are only read when generating configs
+USER_COLUMNS = "id,name,vpn_ip,mtu,public_key,mesh_id"
+
+# Function to list all users, optionally restricted to one mesh
+def list_users(mesh_id=None, with_private_keys=False):
+    """
+    Lists users ordered by ID.
+    Without private keys, a mesh listing is served by the covering index 'idx_users_list'.
+    Arguments:
+        mesh_id : Optional mesh to restrict the list to.
+        with_private_keys : Also return the 'private_key' column.
+    """
+    cols = USER_COLUMNS + (",private_key" if with_private_keys else "")
     conn = get_conn()
-    rows = conn.execute("""
-        SELECT id,name,vpn_ip,mtu,private_key,public_key
-        FROM users ORDER BY id ASC
-    """).fetchall()
+    if mesh_id is None:
+        rows = conn.execute(f"SELECT {cols} FROM users ORDER BY id ASC").fetchall()
+    else:
+        rows = conn.execute(f"SELECT {cols} FROM users WHERE mesh_id=? ORDER BY id ASC", (mesh_id,)).fetchall()
     conn.close()
     return rows
 
+# Function to count the users of a mesh
+def count_users(mesh_id):
+    conn = get_conn()
+    n = conn.execute("SELECT COUNT(*) FROM users WHERE mesh_id=?", (mesh_id,)).fetchone()[0]
+    conn.close()
+    return n
+
+# Function to get a user by its ID
+def get_user(user_id):
+    conn = get_conn()
+    row = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE id=?", (user_id,)).fetchone()
+    conn.close()
+    return row
+
+# Function to get a user by its name
+def get_user_by_name(name, mesh_id=DEFAULT_MESH_ID):
+    conn = get_conn()
+    row = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE mesh_id=? AND name=?", (mesh_id, name)).fetchone()
+    conn.close()
+    return row
+
+# Function to get a user by its VPN IP
+def get_user_by_vpn_ip(vpn_ip, mesh_id=DEFAULT_MESH_ID):
+    conn = get_conn()
+    row = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE mesh_id=? AND vpn_ip=?", (mesh_id, vpn_ip)).fetchone()
+    conn.close()
+    return row
+
+# Function to get a user by its public key
+def get_user_by_public_key(public_key):
+    conn = get_conn()
+    row = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE public_key=?", (public_key,)).fetchone()
+    conn.close()
+    return row
+
 # Function to create a new user
-def create_user(name, mtu, vpn_ip):
+def create_user(name, mtu, vpn_ip, mesh_id=DEFAULT_MESH_ID):
     """
     Adds a new user to the 'users' table.
     Arguments:
-        name : Unique name of the user.
+        name : Name of the user, unique within its mesh.
         mtu : Maximum Transmission Unit (MTU) of the user.
-        vpn_ip : VPN IP address of the user.
+        vpn_ip : VPN IP address of the user, inside the subnet of the mesh
+                 (default: first free address of the subnet).
+        mesh_id : ID of the mesh the user belongs to.
+    Raises:
+        ValueError : If vpn_ip is outside the subnet of the mesh, or the subnet is full.
     """
     conn = get_conn()
-    conn.execute("""
-        INSERT INTO users(name, mtu, vpn_ip)
-        VALUES(?, ?, ?)
-    """, (name, mtu, vpn_ip))
-    conn.commit(); conn.close()
+    try:
+        _check_vpn_ip(conn, mesh_id, vpn_ip)
+        # Roll back and release the lock if the name is already taken
+        with conn:
+            cur = conn.execute("""
+                INSERT INTO users(mesh_id, name, mtu, vpn_ip)
+                VALUES(?, ?, ?, ?)
+            """, (mesh_id, name, mtu, vpn_ip))
+            if not vpn_ip:
+                _assign_vpn_ips(conn, "users", [cur.lastrowid], mesh_id)
+    finally:
+        conn.close()
+    publish("user", {"op": "added", "id": cur.lastrowid, "mesh_id": mesh_id})
 
 # Function to update the VPN IP of a user
 def update_user_vpn_ip(user_id, new_vpn_ip):
@@ -133,11 +414,20 @@ def update_user_vpn_ip(user_id, new_vpn_ip):
     Updates the VPN IP address of an existing user.
     Arguments:
         user_id : ID of the user to update.
-        new_vpn_ip : New VPN IP address.
+        new_vpn_ip : New VPN IP address, inside the subnet of the mesh.
+    Raises:
+        ValueError : If new_vpn_ip is outside the subnet of the mesh.
     """
     conn = get_conn()
-    conn.execute("UPDATE users SET vpn_ip=? WHERE id=?", (new_vpn_ip, user_id))
-    conn.commit(); conn.close()
+    try:
+        row = conn.execute("SELECT mesh_id FROM users WHERE id=?", (user_id,)).fetchone()
+        if row:
+            _check_vpn_ip(conn, row["mesh_id"], new_vpn_ip)
+        conn.execute("UPDATE users SET vpn_ip=? WHERE id=?", (new_vpn_ip, user_id))
+        conn.commit()
+    finally:
+        conn.close()
+    publish("user", {"op": "updated", "id": int(user_id)})
 
 
 # -------- Delete Node ----------
@@ -150,9 +440,13 @@ def delete_node(node_id: int):
         node_id : ID of the node to delete.
     """
     conn = get_conn()
+    row = conn.execute("SELECT mesh_id FROM nodes WHERE id=?", (node_id,)).fetchone()
     conn.execute("DELETE FROM nodes WHERE id=?", (node_id,))
+    conn.execute("DELETE FROM key_history WHERE kind='node' AND peer_id=?", (node_id,))
     conn.commit()
     conn.close()
+    if row:
+        publish("node", {"op": "deleted", "id": int(node_id), "mesh_id": row["mesh_id"]})
 
 # -------- Delete User ----------
 # Function to delete a user
@@ -164,6 +458,86 @@ def delete_user(user_id: int):
         user_id : ID of the user to delete.
     """
     conn = get_conn()
+    row = conn.execute("SELECT mesh_id FROM users WHERE id=?", (user_id,)).fetchone()
     conn.execute("DELETE FROM users WHERE id=?", (user_id,))
+    conn.execute("DELETE FROM key_history WHERE kind='user' AND peer_id=?", (user_id,))
     conn.commit()
     conn.close()
+    if row:
+        publish("user", {"op": "deleted", "id": int(user_id), "mesh_id": row["mesh_id"]})
+
+
+# -------- Keys ----------
+# Tables holding keypairs, by peer kind
+PEER_TABLES = {"node": "nodes", "user": "users"}
+
+# Upper bound for the number of "?" placeholders in a single statement
+_MAX_SQL_VARS = 500
+
+# Function to select the peers whose keys must be rotated
+def list_peers_for_rotation(kind, names=None, stale_days=None, mesh_id=None):
+    """
+    Lists the peers of one kind selected for a key rotation.
+    Without names nor stale_days, every peer is selected.
+    Arguments:
+        kind : "node" or "user".
+        names : Optional list of peer names to rotate.
+        stale_days : Optional age (in days) after which a key is considered stale.
+                     Peers without any key history are always stale.
+        mesh_id : Optional mesh to restrict the selection to.
+    Returns:
+        list : Rows with id, name, public_key and mesh_id.
+    Raises:
+        ValueError : If stale_days is negative.
+    """
+    if stale_days is not None and int(stale_days) < 0:
+        raise ValueError("stale_days must be a non-negative number of days")
+    table = PEER_TABLES[kind]
+    mesh_sql, mesh_args = ("", []) if mesh_id is None else (" AND t.mesh_id=?", [mesh_id])
+    conn = get_conn()
+    if names:
+        names = list(dict.fromkeys(names))
+        rows = []
+        for i in range(0, len(names), _MAX_SQL_VARS):
+            chunk = names[i:i + _MAX_SQL_VARS]
+            rows += conn.execute(f"""
+                SELECT t.id,t.name,t.public_key,t.mesh_id FROM {table} t
+                WHERE t.name IN ({",".join("?" * len(chunk))}){mesh_sql}
+            """, chunk + mesh_args).fetchall()
+        rows.sort(key=lambda r: r["id"])
+    elif stale_days is not None:
+        rows = conn.execute(f"""
+            SELECT t.id,t.name,t.public_key,t.mesh_id FROM {table} t
+            WHERE NOT EXISTS (
+                SELECT 1 FROM key_history h
+                WHERE h.kind=? AND h.peer_id=t.id AND h.rotated_at >= datetime('now', ?)
+            ){mesh_sql}
+            ORDER BY t.id ASC
+        """, [kind, f"-{int(stale_days)} days"] + mesh_args).fetchall()
+    else:
+        rows = conn.execute(f"""
+            SELECT t.id,t.name,t.public_key,t.mesh_id FROM {table} t
+            WHERE 1=1{mesh_sql} ORDER BY t.id ASC
+        """, mesh_args).fetchall()
+    conn.close()
+    return rows
+
+# Function to store a batch of new keypairs
+def store_keys(kind, keys):
+    """
+    Stores a batch of keypairs and records them in 'key_history', in one transaction.
+    Arguments:
+        kind : "node" or "user".
+        keys : List of (peer_id, old_public_key, private_key, public_key) tuples.
+    """
+    table = PEER_TABLES[kind]
+    conn = get_conn()
+    with conn:
+        conn.executemany(f"UPDATE {table} SET private_key=?, public_key=? WHERE id=?",
+                         [(priv, pub, peer_id) for peer_id, _, priv, pub in keys])
+        conn.executemany("""
+            INSERT INTO key_history(kind, peer_id, old_public_key, public_key)
+            VALUES (?, ?, ?, ?)
+        """, [(kind, peer_id, old_pub, pub) for peer_id, old_pub, _, pub in keys])
+    conn.close()
+    publish(kind, {"op": "keys", "ids": [k[0] for k in keys]})
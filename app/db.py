@@ -3,12 +3,17 @@ import sqlite3
 import os
 
 # Path to the SQLite database file, with a default value
-DB_PATH = os.environ.get("WG_DB", "./data/wireguard.db")
+# (WG_DB is the historical CLI variable, DB_FILE the one used by the web app)
+DB_PATH = os.environ.get("WG_DB") or os.environ.get("DB_FILE") or "/data/wireguard.db"
+
+# ID of the mesh created at initialization, used when no mesh is given
+DEFAULT_MESH_ID = 1
 
 def get_conn():
     """
     Establishes and returns a connection to the SQLite database.
     Ensures the directory for the database file exists.
+    Rows are returned as sqlite3.Row (access by index or by column name).
     Arguments:
         None
     Returns:
@@ -19,21 +24,17 @@ def get_conn():
     if d and not os.path.exists(d):
         os.makedirs(d, exist_ok=True)
     conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    """
-    Initializes the SQLite database by creating the 'nodes' and 'users' tables if they don't exist.
-    Arguments:
-        None
-    Returns:
-        None
-    """
-    
-    conn = get_conn()
-    c = conn.cursor()
-    
-    # Create the 'nodes' table to store information about network nodes
+
+# -------- Migrations ----------
+# Each migration receives a connection inside an open transaction.
+# Migrations must stay idempotent: databases created before versioning
+# (user_version = 0) may already contain part of the schema.
+
+def _m1_base_tables(c):
+    """Creates the original 'nodes' and 'users' tables."""
     c.execute("""
     CREATE TABLE IF NOT EXISTS nodes (
       id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -41,23 +42,163 @@ def init_db():
       public_ip TEXT,
       vpn_ip TEXT,
       port INTEGER,
-      mtu INTEGER DEFAULT 1420,
+      mtu INTEGER,
       private_key TEXT,
       public_key TEXT
-    )
-    """)
-    # Create the 'users' table to store information about users
+    )""")
     c.execute("""
     CREATE TABLE IF NOT EXISTS users (
       id INTEGER PRIMARY KEY AUTOINCREMENT,
       name TEXT UNIQUE,
       vpn_ip TEXT,
-      mtu INTEGER DEFAULT 1420,
+      mtu INTEGER,
       private_key TEXT,
       public_key TEXT
-    )
-    """)
-    
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
+    )""")
+
+def _m2_key_history(c):
+    """Creates the history of generated keypairs (public keys only)."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS key_history (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      kind TEXT NOT NULL,
+      peer_id INTEGER NOT NULL,
+      old_public_key TEXT,
+      public_key TEXT NOT NULL,
+      rotated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )""")
+
+def _m3_meshes(c):
+    """Creates the 'meshes' table with the default mesh, and attaches nodes/users to it."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS meshes (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      name TEXT UNIQUE NOT NULL,
+      subnet TEXT,
+      default_port INTEGER,
+      default_mtu INTEGER,
+      output_dir TEXT
+    )""")
+    c.execute("""
+    INSERT OR IGNORE INTO meshes(id, name, subnet, default_port, default_mtu)
+    VALUES (?, 'default', '10.100.10.0/24', 51820, 1420)
+    """, (DEFAULT_MESH_ID,))
+    for table in ("nodes", "users"):
+        cols = [r[1] for r in c.execute(f"PRAGMA table_info({table})")]
+        if "mesh_id" not in cols:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN mesh_id INTEGER NOT NULL DEFAULT {DEFAULT_MESH_ID}")
+
+def _m4_names_unique_per_mesh(c):
+    """Rebuilds 'nodes' and 'users' so that names are unique per mesh instead of globally."""
+    tables = {
+        "nodes": """
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          mesh_id INTEGER NOT NULL DEFAULT 1 REFERENCES meshes(id),
+          name TEXT,
+          public_ip TEXT,
+          vpn_ip TEXT,
+          port INTEGER,
+          mtu INTEGER,
+          private_key TEXT,
+          public_key TEXT,
+          UNIQUE(mesh_id, name)""",
+        "users": """
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          mesh_id INTEGER NOT NULL DEFAULT 1 REFERENCES meshes(id),
+          name TEXT,
+          vpn_ip TEXT,
+          mtu INTEGER,
+          private_key TEXT,
+          public_key TEXT,
+          UNIQUE(mesh_id, name)""",
+    }
+    for table, body in tables.items():
+        cols = ",".join(r[1] for r in c.execute(f"PRAGMA table_info({table})"))
+        seq = c.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+        c.execute(f"CREATE TABLE {table}_new ({body})")
+        c.execute(f"INSERT INTO {table}_new({cols}) SELECT {cols} FROM {table}")
+        c.execute(f"DROP TABLE {table}")
+        c.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        # Keep AUTOINCREMENT from reusing the IDs of deleted rows
+        if seq:
+            c.execute("DELETE FROM sqlite_sequence WHERE name=?", (table,))
+            c.execute("INSERT INTO sqlite_sequence(name, seq) VALUES (?, ?)", (table, seq[0]))
+
+def _m5_indexes(c):
+    """Adds indexes for point lookups (name, vpn_ip, public_key) and covering indexes for list queries."""
+    # Lookups by name use the UNIQUE(mesh_id, name) index created with the tables
+    c.execute("CREATE INDEX IF NOT EXISTS idx_nodes_vpn_ip ON nodes(mesh_id, vpn_ip)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_vpn_ip ON users(mesh_id, vpn_ip)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_nodes_public_key ON nodes(public_key)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_public_key ON users(public_key)")
+    # Covering indexes: list pages and counters are served from the index, in id order
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_nodes_list
+                 ON nodes(mesh_id, id, name, public_ip, vpn_ip, port, mtu, public_key)""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_users_list
+                 ON users(mesh_id, id, name, vpn_ip, mtu, public_key)""")
+    # Stale-key selection of the key rotation
+    c.execute("CREATE INDEX IF NOT EXISTS idx_key_history_peer ON key_history(kind, peer_id, rotated_at)")
+
+# Ordered list of migrations; the database 'user_version' is the number of applied ones
+MIGRATIONS = [
+    _m1_base_tables,
+    _m2_key_history,
+    _m3_meshes,
+    _m4_names_unique_per_mesh,
+    _m5_indexes,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def init_db():
+    """
+    Brings the database schema up to date by applying the pending migrations.
+    Each migration runs in its own transaction and bumps PRAGMA user_version,
+    so concurrent processes (web app, CLI) never apply the same migration twice.
+    Arguments:
+        None
+    Returns:
+        int : Schema version of the database.
+    """
+    conn = get_conn()
+    conn.isolation_level = None  # explicit transactions
+    try:
+        # WAL lets readers (pages, SSE row fetches, backups) run while a writer commits
+        conn.execute("PRAGMA journal_mode=WAL")
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                conn.execute("COMMIT")
+                return version
+            try:
+                MIGRATIONS[version](conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
+
+def reset_db():
+    """
+    Drops every table and recreates an empty schema at the latest version.
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    conn = get_conn()
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        tables = [r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+        conn.execute("PRAGMA user_version = 0")
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    init_db()
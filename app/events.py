@@ -0,0 +1,91 @@
+# app/events.py
+import asyncio
+import json
+import threading
+
+# Maximum number of pending events per client before it is asked to resync
+QUEUE_SIZE = 256
+
+# Seconds without event after which a keepalive comment is sent to the client
+KEEPALIVE = 15
+
+
+class Broker:
+    """
+    In-process publish/subscribe of change events, used by the SSE stream.
+    Publishers can be any thread (CRUD functions run in the FastAPI thread pool);
+    each subscriber owns a bounded asyncio.Queue living in the event loop.
+    A client too slow to drain its queue loses its backlog and receives a single
+    'resync' event instead, so memory stays bounded whatever the number of changes.
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._subs = {}
+
+    def subscribe(self):
+        """
+        Registers a new subscriber. Must be called from the event loop.
+        Returns:
+            asyncio.Queue : Queue receiving (event, data) tuples.
+        """
+        q = asyncio.Queue(maxsize=self.maxsize)
+        with self._lock:
+            self._subs[q] = asyncio.get_running_loop()
+        return q
+
+    def unsubscribe(self, q):
+        """
+        Removes a subscriber.
+        Arguments:
+            q : Queue returned by subscribe().
+        """
+        with self._lock:
+            self._subs.pop(q, None)
+
+    def publish(self, event, data):
+        """
+        Sends an event to every subscriber. Safe to call from any thread, never blocks.
+        Arguments:
+            event : Event name (e.g. "node", "user", "genmesh").
+            data : JSON-serializable dict.
+        """
+        with self._lock:
+            subs = list(self._subs.items())
+        for q, loop in subs:
+            try:
+                loop.call_soon_threadsafe(_offer, q, (event, data))
+            except RuntimeError:
+                # Event loop already closed
+                self.unsubscribe(q)
+
+
+def _offer(q, item):
+    """
+    Puts an event in a subscriber queue, from the event loop thread.
+    When the queue is full, the backlog is dropped and replaced by a 'resync' event.
+    """
+    if q.full():
+        while not q.empty():
+            q.get_nowait()
+        q.put_nowait(("resync", {}))
+    else:
+        q.put_nowait(item)
+
+
+def format_sse(event, data):
+    """
+    Formats an event for the text/event-stream protocol.
+    Arguments:
+        event : Event name.
+        data : JSON-serializable dict.
+    Returns:
+        str : SSE message.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+# Broker shared by the CRUD functions and the /events route
+broker = Broker()
+publish = broker.publish
@@ -1,8 +1,12 @@
 from pathlib import Path
+import asyncio
 import shutil
+import sqlite3
 
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import RedirectResponse, FileResponse, HTMLResponse
+from datetime import datetime
+
+from fastapi import FastAPI, Request, Form, File, UploadFile
+from fastapi.responses import RedirectResponse, FileResponse, HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import io, zipfile
@@ -10,6 +14,8 @@ from fastapi.responses import StreamingResponse
 
 from app import crud
 from app import wireguard
+from app import backup
+from app import events
 
 # Define base directories for templates, static files, and configuration
 BASE_DIR = Path(__file__).resolve().parent
@@ -30,6 +36,18 @@ app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 # Initialize Jinja2 templates for rendering HTML pages
 templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
 
+@app.middleware("http")
+async def live_forms(request: Request, call_next):
+    """
+    Forms submitted by the live script (header 'X-Live') do not follow the 303 redirect:
+    the page is patched from the SSE stream instead of being fully re-rendered.
+    The redirect target is returned in the 'X-Location' header.
+    """
+    response = await call_next(request)
+    if request.headers.get("x-live") and response.status_code == 303:
+        return Response(status_code=204, headers={"X-Location": response.headers["location"]})
+    return response
+
 @app.on_event("startup")
 def startup():
     """
@@ -38,197 +56,438 @@ def startup():
     crud.init_db()
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
 
+def _mesh_or_default(mesh_id):
+    """
+    Return the mesh with the given ID, or the default mesh if it does not exist.
+    """
+    return crud.get_mesh(mesh_id) or crud.get_mesh(crud.DEFAULT_MESH_ID)
+
+def _clear_mesh_configs(mesh):
+    """
+    Delete the generated configuration files of a mesh (nothing if its output directory is invalid).
+    """
+    try:
+        wireguard.clear_configs(wireguard.mesh_output_dir(mesh))
+    except ValueError:
+        pass
+
 # Pages
 @app.get("/", response_class=HTMLResponse)
-def dashboard(request: Request):
+def dashboard(request: Request, mesh: int = crud.DEFAULT_MESH_ID):
     """
-    Render the dashboard page with a list of nodes and users.
+    Render the dashboard page with the number of nodes and users of a mesh.
     """
-    nodes = crud.list_nodes()
-    users = crud.list_users()
-    return templates.TemplateResponse("index.html", {"request": request, "nodes": nodes, "users": users})
+    mesh = _mesh_or_default(mesh)
+    node_count = crud.count_nodes(mesh["id"])
+    user_count = crud.count_users(mesh["id"])
+    return templates.TemplateResponse("index.html", {"request": request, "node_count": node_count,
+                                                     "user_count": user_count,
+                                                     "mesh": mesh, "meshes": crud.list_meshes()})
 
 
 @app.get("/nodes", response_class=HTMLResponse)
-def page_nodes(request: Request):
+def page_nodes(request: Request, mesh: int = crud.DEFAULT_MESH_ID):
     """
-    Render the nodes page with a list of all nodes.
+    Render the nodes page with a list of all nodes of a mesh.
     """
-    nodes = crud.list_nodes()
-    return templates.TemplateResponse("nodes.html", {"request": request, "nodes": nodes})
+    mesh = _mesh_or_default(mesh)
+    nodes = crud.list_nodes(mesh["id"])
+    return templates.TemplateResponse("nodes.html", {"request": request, "nodes": nodes,
+                                                     "mesh": mesh, "meshes": crud.list_meshes()})
 
 @app.get("/users", response_class=HTMLResponse)
-def page_users(request: Request):
+def page_users(request: Request, mesh: int = crud.DEFAULT_MESH_ID):
     """
-    Render the users page with a list of all users.
+    Render the users page with a list of all users of a mesh.
     """
-    users = crud.list_users()
-    return templates.TemplateResponse("users.html", {"request": request, "users": users})
+    mesh = _mesh_or_default(mesh)
+    users = crud.list_users(mesh["id"])
+    return templates.TemplateResponse("users.html", {"request": request, "users": users,
+                                                     "mesh": mesh, "meshes": crud.list_meshes()})
 
 @app.get("/overview", response_class=HTMLResponse)
-def page_overview(request: Request):    
+def page_overview(request: Request, mesh: int = crud.DEFAULT_MESH_ID):
     """
-    Render the overview page with a summary of nodes and users.
+    Render the overview page with a summary of nodes and users of a mesh.
     """
-    nodes = crud.list_nodes()
-    users = crud.list_users()
+    mesh = _mesh_or_default(mesh)
+    nodes = crud.list_nodes(mesh["id"])
+    users = crud.list_users(mesh["id"])
     return templates.TemplateResponse(
         "overview.html",
-        {"request": request, "nodes": nodes, "users": users}
+        {"request": request, "nodes": nodes, "users": users, "mesh": mesh, "meshes": crud.list_meshes()}
     )
 
+@app.get("/meshes", response_class=HTMLResponse)
+def page_meshes(request: Request, mesh: int = crud.DEFAULT_MESH_ID):
+    """
+    Render the meshes page with a list of all meshes.
+    """
+    mesh = _mesh_or_default(mesh)
+    meshes = crud.list_meshes()
+    output_dirs = {}
+    for m in meshes:
+        try:
+            output_dirs[m["id"]] = str(wireguard.mesh_output_dir(m))
+        except ValueError:
+            output_dirs[m["id"]] = "(invalide)"
+    return templates.TemplateResponse("meshes.html", {"request": request, "mesh": mesh, "meshes": meshes,
+                                                      "output_dirs": output_dirs})
+
+# Live updates
+@app.get("/events")
+async def event_stream(request: Request, mesh: int = None):
+    """
+    Server-Sent Events stream of change events (nodes, users, meshes, keys, genmesh progress).
+    Events carrying a 'mesh_id' of another mesh than the requested one are filtered out.
+    """
+    q = events.broker.subscribe()
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    name, data = await asyncio.wait_for(q.get(), timeout=events.KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if mesh is not None and data.get("mesh_id", mesh) != mesh:
+                    continue
+                yield events.format_sse(name, data)
+        finally:
+            events.broker.unsubscribe(q)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/nodes/{node_id}/row", response_class=HTMLResponse)
+def node_row(request: Request, node_id: int, view: str = "nodes"):
+    """
+    Render a single node row, used by the live script to patch tables.
+    Arguments:
+        node_id : ID of the node.
+        view : "nodes" or "overview" (table the row belongs to).
+    """
+    node = crud.get_node(node_id)
+    if node is None:
+        return HTMLResponse("", status_code=404)
+    template = "_overview_node_row.html" if view == "overview" else "_node_row.html"
+    return templates.TemplateResponse(template, {"request": request, "n": node, "mesh": crud.get_mesh(node["mesh_id"])})
+
+@app.get("/users/{user_id}/row", response_class=HTMLResponse)
+def user_row(request: Request, user_id: int, view: str = "users"):
+    """
+    Render a single user row, used by the live script to patch tables.
+    Arguments:
+        user_id : ID of the user.
+        view : "users" or "overview" (table the row belongs to).
+    """
+    user = crud.get_user(user_id)
+    if user is None:
+        return HTMLResponse("", status_code=404)
+    template = "_overview_user_row.html" if view == "overview" else "_user_row.html"
+    return templates.TemplateResponse(template, {"request": request, "u": user, "mesh": crud.get_mesh(user["mesh_id"])})
+
+# Meshes CRUD
+@app.post("/meshes/add")
+def add_mesh(name: str = Form(...), subnet: str = Form(""), default_port: str = Form("51820"),
+             default_mtu: str = Form("1420"), output_dir: str = Form("")):
+    """
+    Add a new mesh (isolated WireGuard network).
+    Arguments:
+        name : Name of the mesh (letters, digits, '-' and '_').
+        subnet : VPN subnet of the mesh (e.g. 10.200.0.0/24).
+        default_port : Port used by nodes without an explicit port.
+        default_mtu : MTU used by nodes and users without an explicit MTU.
+        output_dir : Directory for the generated configs (optional).
+    """
+    try:
+        port_val = int(default_port)
+    except Exception:
+        port_val = 51820
+    try:
+        mtu_val = int(default_mtu)
+    except Exception:
+        mtu_val = None
+    try:
+        mesh_id = wireguard.create_mesh(name=name, subnet=subnet or None, default_port=port_val,
+                                        default_mtu=mtu_val, output_dir=output_dir or None)
+    except (ValueError, sqlite3.IntegrityError):
+        return RedirectResponse("/meshes?notice=mesh-invalid", status_code=303)
+    return RedirectResponse(f"/meshes?mesh={mesh_id}&notice=mesh-added", status_code=303)
+
+@app.post("/meshes/delete")
+def delete_mesh(mesh_id: int = Form(...)):
+    """
+    Delete a mesh with its nodes, users and generated configuration files.
+    Arguments:
+        mesh_id : ID of the mesh to delete.
+    """
+    mesh = crud.get_mesh(mesh_id)
+    if mesh is None or mesh_id == crud.DEFAULT_MESH_ID:
+        return RedirectResponse("/meshes?notice=mesh-invalid", status_code=303)
+    _clear_mesh_configs(mesh)
+    crud.delete_mesh(mesh_id)
+    return RedirectResponse("/meshes?notice=mesh-deleted", status_code=303)
+
 # Nodes CRUD
 @app.post("/nodes/add")
-def add_node(name: str = Form(...), public_ip: str = Form(""), port: str = Form("51820"),
-             mtu: str = Form(None), vpn_ip: str = Form(None)):
+def add_node(name: str = Form(...), public_ip: str = Form(""), port: str = Form(""),
+             mtu: str = Form(None), vpn_ip: str = Form(None), mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
     
     """
     Add a new node to the database.
     Arguments:
         name : Name of the node.
         public_ip : Public IP address of the node.
-        port : Port used by the node (default: 51820).
+        port : Port used by the node (default: port of the mesh).
         mtu : Maximum Transmission Unit (optional).
         vpn_ip : VPN IP address of the node (optional).
+        mesh_id : ID of the mesh the node belongs to.
     """    
+    mesh = _mesh_or_default(mesh_id)
         # Validate and convert port and mtu to integers if provided
     try:
         port_val = int(port)
     except Exception:
-        port_val = 51820
+        port_val = mesh["default_port"] or 51820
     mtu_val = None
     if mtu not in (None, "", "-", "None"):
         try:
             mtu_val = int(mtu)
         except Exception:
             mtu_val = None
-    crud.create_node(name=name, public_ip=public_ip, port=port_val, mtu=mtu_val, vpn_ip=vpn_ip)
-    return RedirectResponse("/nodes?notice=node-added", status_code=303)
+    try:
+        crud.create_node(name=name, public_ip=public_ip, port=port_val, mtu=mtu_val, vpn_ip=vpn_ip,
+                         mesh_id=mesh["id"])
+    except sqlite3.IntegrityError:
+        return RedirectResponse(f"/nodes?mesh={mesh['id']}&notice=name-taken", status_code=303)
+    except ValueError:
+        return RedirectResponse(f"/nodes?mesh={mesh['id']}&notice=vpn-invalid", status_code=303)
+    return RedirectResponse(f"/nodes?mesh={mesh['id']}&notice=node-added", status_code=303)
 
 @app.post("/nodes/update-ip")
-def update_node_public_ip(node_id: int = Form(...), new_ip: str = Form(...)):
+def update_node_public_ip(node_id: int = Form(...), new_ip: str = Form(...),
+                          mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
     """
     Update the public IP address of a node.
     Arguments:
         node_id : ID of the node to update.
         new_ip : New public IP address.
+        mesh_id : ID of the mesh displayed after the update.
     """    
     crud.update_node_public_ip(node_id, new_ip)
-    return RedirectResponse("/nodes?notice=ip-updated", status_code=303)
+    return RedirectResponse(f"/nodes?mesh={mesh_id}&notice=ip-updated", status_code=303)
 
 @app.post("/nodes/update-vpn-ip")
-def update_node_vpn_ip(node_id: int = Form(...), new_vpn_ip: str = Form(...)):
+def update_node_vpn_ip(node_id: int = Form(...), new_vpn_ip: str = Form(...),
+                       mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
     """
     Update the VPN IP address of a node.
     Arguments:
         node_id : ID of the node to update.
         new_vpn_ip : New VPN IP address.
+        mesh_id : ID of the mesh displayed after the update.
     """    
-    crud.update_node_vpn_ip(node_id, new_vpn_ip)
-    return RedirectResponse("/nodes?notice=vpn-updated", status_code=303)
+    try:
+        crud.update_node_vpn_ip(node_id, new_vpn_ip)
+    except ValueError:
+        return RedirectResponse(f"/nodes?mesh={mesh_id}&notice=vpn-invalid", status_code=303)
+    return RedirectResponse(f"/nodes?mesh={mesh_id}&notice=vpn-updated", status_code=303)
 
 # Users CRUD
 @app.post("/users/add")
-def add_user(name: str = Form(...), mtu: str = Form(None), vpn_ip: str = Form(None)):
+def add_user(name: str = Form(...), mtu: str = Form(None), vpn_ip: str = Form(None),
+             mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
     """
     Add a new user to the database.
     Arguments:
         name : Name of the user.
         mtu : Maximum Transmission Unit (optional).
         vpn_ip : VPN IP address of the user (optional).
+        mesh_id : ID of the mesh the user belongs to.
     """ 
+    mesh = _mesh_or_default(mesh_id)
     mtu_val = None
     if mtu not in (None, "", "-", "None"):
         try:
             mtu_val = int(mtu)
         except Exception:
             mtu_val = None
-    crud.create_user(name=name, mtu=mtu_val, vpn_ip=vpn_ip)
-    return RedirectResponse("/users?notice=user-added", status_code=303)
+    try:
+        crud.create_user(name=name, mtu=mtu_val, vpn_ip=vpn_ip, mesh_id=mesh["id"])
+    except sqlite3.IntegrityError:
+        return RedirectResponse(f"/users?mesh={mesh['id']}&notice=name-taken", status_code=303)
+    except ValueError:
+        return RedirectResponse(f"/users?mesh={mesh['id']}&notice=vpn-invalid", status_code=303)
+    return RedirectResponse(f"/users?mesh={mesh['id']}&notice=user-added", status_code=303)
 
 @app.post("/users/update-vpn-ip")
-def update_user_vpn_ip(user_id: int = Form(...), new_vpn_ip: str = Form(...)):
+def update_user_vpn_ip(user_id: int = Form(...), new_vpn_ip: str = Form(...),
+                       mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
     """
     Update the VPN IP address of a user.
     Arguments:
         user_id : ID of the user to update.
         new_vpn_ip : New VPN IP address.
+        mesh_id : ID of the mesh displayed after the update.
     """    
-    crud.update_user_vpn_ip(user_id, new_vpn_ip)
-    return RedirectResponse("/users?notice=user-vpn-updated", status_code=303)
+    try:
+        crud.update_user_vpn_ip(user_id, new_vpn_ip)
+    except ValueError:
+        return RedirectResponse(f"/users?mesh={mesh_id}&notice=vpn-invalid", status_code=303)
+    return RedirectResponse(f"/users?mesh={mesh_id}&notice=user-vpn-updated", status_code=303)
 
 # Configuration management
 @app.post("/genmesh")
-def genmesh():
+def genmesh(mesh_id: str = Form(str(crud.DEFAULT_MESH_ID))):
     """
-    Generate WireGuard configuration files for all nodes and users.
+    Generate WireGuard configuration files for the nodes and users of one mesh,
+    or of every mesh in parallel when mesh_id is "all".
+    Arguments:
+        mesh_id : ID of the mesh to generate, or "all".
     """
     # Generate configurations    
-    wireguard.generate_configs()
-    return RedirectResponse("/?notice=gen-ok", status_code=303)
+    if mesh_id == "all":
+        results = wireguard.generate_all_meshes()
+        back = crud.DEFAULT_MESH_ID
+    else:
+        mesh = _mesh_or_default(int(mesh_id) if mesh_id.isdigit() else crud.DEFAULT_MESH_ID)
+        results = {mesh["id"]: wireguard.generate_configs(mesh["id"])}
+        back = mesh["id"]
+    ok = all(r["status"] == "ok" for r in results.values())
+    return RedirectResponse(f"/?mesh={back}&notice={'gen-ok' if ok else 'gen-error'}", status_code=303)
+
+@app.post("/keys/rotate")
+def rotate_keys(selector: str = Form("all"), stale_days: str = Form(""), names: str = Form(""),
+                mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
+    """
+    Rotate the keys of the nodes and users of a mesh, then regenerate the affected configuration files.
+    Arguments:
+        selector : "all", "stale" (keys older than stale_days) or "names".
+        stale_days : Key age in days, used with the "stale" selector.
+        names : Comma-separated list of node/user names, used with the "names" selector.
+        mesh_id : ID of the mesh whose keys are rotated.
+    """
+    if selector == "stale":
+        try:
+            days = int(stale_days)
+        except Exception:
+            return RedirectResponse(f"/?mesh={mesh_id}&notice=keys-invalid", status_code=303)
+        if days < 0:
+            return RedirectResponse(f"/?mesh={mesh_id}&notice=keys-invalid", status_code=303)
+        res = wireguard.rotate_keys(stale_days=days, mesh_id=mesh_id)
+    elif selector == "names":
+        name_list = [n.strip() for n in names.split(",") if n.strip()]
+        if not name_list:
+            return RedirectResponse(f"/?mesh={mesh_id}&notice=keys-invalid", status_code=303)
+        res = wireguard.rotate_keys(names=name_list, mesh_id=mesh_id)
+        if res["status"] == "no-match":
+            return RedirectResponse(f"/?mesh={mesh_id}&notice=keys-no-match", status_code=303)
+    else:
+        res = wireguard.rotate_keys(mesh_id=mesh_id)
+    if res["status"] == "error":
+        return RedirectResponse(f"/?mesh={mesh_id}&notice=keys-error&rotated={res['nodes'] + res['users']}",
+                                status_code=303)
+    return RedirectResponse(f"/?mesh={mesh_id}&notice=keys-rotated", status_code=303)
 
 @app.post("/configs/clear")
-def clear_configs():
+def clear_configs(mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
     """
-    Clear all configuration files (.conf and .zip) from the configuration directory.
+    Clear the generated configuration files (node-*.conf, user-*.conf) of a mesh.
+    Arguments:
+        mesh_id : ID of the mesh whose files are cleared.
     """    
-    for p in CONFIG_DIR.glob("*"):
-        if p.is_file() and p.suffix in (".conf", ".zip"):
-            try: p.unlink()
-            except Exception: pass
-    return RedirectResponse("/?notice=configs-cleared", status_code=303)
+    mesh = _mesh_or_default(mesh_id)
+    _clear_mesh_configs(mesh)
+    return RedirectResponse(f"/?mesh={mesh['id']}&notice=configs-cleared", status_code=303)
 
 @app.get("/configs/all.zip")
-def download_zip():
+def download_zip(mesh: int = crud.DEFAULT_MESH_ID):
     """
-    Create and return a ZIP file containing all configuration files.
+    Create and return a ZIP file containing all configuration files of a mesh.
     """    
+    mesh = _mesh_or_default(mesh)
+    try:
+        config_dir = wireguard.mesh_output_dir(mesh)
+    except ValueError:
+        config_dir = None
     # Create a ZIP file in memory
     buffer = io.BytesIO()
     with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        for p in CONFIG_DIR.glob("*.conf"):
+        for p in (config_dir.glob("*.conf") if config_dir else ()):
             zf.write(p, arcname=p.name)
     buffer.seek(0)
 
+    filename = "wireguard-configs.zip" if mesh["id"] == crud.DEFAULT_MESH_ID else f"wireguard-configs-{mesh['name']}.zip"
     return StreamingResponse(
         buffer,
         media_type="application/zip",
-        headers={"Content-Disposition": "attachment; filename=wireguard-configs.zip"}
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 @app.post("/reset-db")
 def reset_db():
     """
     Reset the database by dropping all tables and recreating them.
-    Also clears all configuration files.
+    Also clears the generated configuration files, of every mesh.
     """    
-    conn = crud.get_conn(); c = conn.cursor()
-    c.execute("DROP TABLE IF EXISTS nodes")
-    c.execute("DROP TABLE IF EXISTS users")
-    conn.commit(); conn.close()
-    crud.init_db()
-    for p in CONFIG_DIR.glob("*"):
-        if p.is_file():
-            try: p.unlink()
-            except Exception: pass
+    for m in crud.list_meshes():
+        _clear_mesh_configs(m)
+    crud.reset_db()
+    events.publish("resync", {})
     return RedirectResponse("/?notice=db-reset", status_code=303)
 
+# Backup / restore
+@app.get("/admin/backup")
+def admin_backup():
+    """
+    Stream a gzip-compressed snapshot of the database.
+    The snapshot is taken with the SQLite online backup API, so writers are not blocked.
+    """
+    filename = f"wireguard-{datetime.now():%Y%m%d-%H%M%S}.db.gz"
+    return StreamingResponse(
+        backup.iter_backup(),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@app.post("/admin/restore")
+def admin_restore(file: UploadFile = File(...)):
+    """
+    Replace the database with an uploaded snapshot, after checking its integrity.
+    Arguments:
+        file : Backup file (.db.gz or raw .db).
+    """
+    try:
+        backup.restore(file.file)
+    except ValueError:
+        return RedirectResponse("/?notice=restore-invalid", status_code=303)
+    events.publish("resync", {})
+    return RedirectResponse("/?notice=db-restored", status_code=303)
+
 @app.post("/nodes/delete")
-def delete_node(node_id: int = Form(...)):
+def delete_node(node_id: int = Form(...), mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
     """
     Delete a node from the database.
     Arguments:
         node_id : ID of the node to delete.
+        mesh_id : ID of the mesh displayed after the deletion.
     """    
     crud.delete_node(node_id)
-    return RedirectResponse("/nodes?notice=node-deleted", status_code=303)
+    return RedirectResponse(f"/nodes?mesh={mesh_id}&notice=node-deleted", status_code=303)
 
 @app.post("/users/delete")
-def delete_user(user_id: int = Form(...)):
+def delete_user(user_id: int = Form(...), mesh_id: int = Form(crud.DEFAULT_MESH_ID)):
     """
     Delete a user from the database.
     Arguments:
         user_id : ID of the user to delete.
+        mesh_id : ID of the mesh displayed after the deletion.
     """    
     crud.delete_user(user_id)
-    return RedirectResponse("/users?notice=user-deleted", status_code=303)
+    return RedirectResponse(f"/users?mesh={mesh_id}&notice=user-deleted", status_code=303)
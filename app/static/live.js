@@ -0,0 +1,138 @@
+// Live updates: patch the page from the /events SSE stream instead of reloading it.
+(function () {
+  "use strict";
+
+  // Notices that need the full page (error messages rendered server-side)
+  const RELOAD_NOTICES = ["name-taken", "vpn-invalid", "gen-error", "keys-invalid", "keys-no-match", "keys-error", "mesh-invalid"];
+  // Above this number of changed rows, reloading is cheaper than patching row by row
+  const MAX_PATCHED_ROWS = 50;
+
+  const mesh = document.body.dataset.mesh;
+
+  function tables(kind) {
+    return document.querySelectorAll(`tbody[data-live="${kind}"]`);
+  }
+
+  async function fetchRow(kind, id, view) {
+    const res = await fetch(`/${kind}s/${id}/row?view=${view}`);
+    if (!res.ok) return null;
+    const tpl = document.createElement("template");
+    tpl.innerHTML = (await res.text()).trim();
+    return tpl.content.firstElementChild;
+  }
+
+  async function patchRow(kind, id, insert) {
+    for (const tbody of tables(kind)) {
+      const current = tbody.querySelector(`tr[data-id="${id}"]`);
+      if (!current && !insert) continue;
+      const row = await fetchRow(kind, id, tbody.dataset.view);
+      if (!row) continue;
+      if (current) {
+        current.replaceWith(row);
+      } else {
+        tbody.querySelectorAll(".empty-row").forEach((r) => r.remove());
+        tbody.appendChild(row);
+      }
+      bindForms(row);
+    }
+  }
+
+  function removeRow(kind, id) {
+    for (const tbody of tables(kind)) {
+      const current = tbody.querySelector(`tr[data-id="${id}"]`);
+      if (current) current.remove();
+    }
+  }
+
+  function count(kind, delta) {
+    document.querySelectorAll(`[data-count="${kind}"]`).forEach((el) => {
+      el.textContent = String(Math.max(0, parseInt(el.textContent, 10) + delta));
+    });
+  }
+
+  function status(text) {
+    const el = document.getElementById("live-status");
+    if (!el) return;
+    el.textContent = text;
+    el.classList.remove("hidden");
+  }
+
+  function onPeer(kind, ev) {
+    const data = JSON.parse(ev.data);
+    if (data.op === "added") {
+      count(kind, 1);
+      patchRow(kind, data.id, true);
+    } else if (data.op === "updated") {
+      patchRow(kind, data.id, false);
+    } else if (data.op === "deleted") {
+      count(kind, -1);
+      removeRow(kind, data.id);
+    } else if (data.op === "keys") {
+      const shown = data.ids.filter((id) =>
+        Array.from(tables(kind)).some((t) => t.querySelector(`tr[data-id="${id}"]`)));
+      if (shown.length > MAX_PATCHED_ROWS) {
+        window.location.reload();
+      } else {
+        shown.forEach((id) => patchRow(kind, id, false));
+      }
+    }
+  }
+
+  function onGenmesh(ev) {
+    const data = JSON.parse(ev.data);
+    if (data.state === "running") {
+      const progress = data.total ? ` : ${data.done}/${data.total} fichiers` : "";
+      status(`⏳ Génération du réseau ${data.mesh_id} en cours${progress}`);
+    } else if (data.state === "done") {
+      status(`✅ Réseau ${data.mesh_id} : fichiers de configuration générés.`);
+    } else {
+      status(`⚠️ Réseau ${data.mesh_id} : la génération a échoué.`);
+    }
+  }
+
+  function connect() {
+    const live = document.querySelector("tbody[data-live], [data-count], #live-status");
+    if (!live || !window.EventSource) return;
+    const source = new EventSource(mesh ? `/events?mesh=${mesh}` : "/events");
+    source.addEventListener("node", (ev) => onPeer("node", ev));
+    source.addEventListener("user", (ev) => onPeer("user", ev));
+    source.addEventListener("genmesh", onGenmesh);
+    source.addEventListener("resync", () => window.location.reload());
+    source.addEventListener("mesh", () => {
+      if (window.location.pathname === "/meshes") window.location.reload();
+    });
+  }
+
+  // Forms marked data-live-form are posted in the background; the SSE stream patches the page
+  function bindForms(root) {
+    root.querySelectorAll("form[data-live-form]").forEach((form) => {
+      form.addEventListener("submit", async (ev) => {
+        if (ev.defaultPrevented) return;  // cancelled by an inline confirm()
+        ev.preventDefault();
+        let res;
+        try {
+          res = await fetch(form.action, { method: "POST", body: new FormData(form), headers: { "X-Live": "1" } });
+        } catch (e) {
+          form.submit();
+          return;
+        }
+        const location = res.headers.get("X-Location");
+        if (res.status !== 204 || !location) {
+          form.submit();
+          return;
+        }
+        const notice = new URL(location, window.location.href).searchParams.get("notice");
+        if (RELOAD_NOTICES.includes(notice)) {
+          window.location = location;
+          return;
+        }
+        form.querySelectorAll("input:not([type=hidden])").forEach((input) => {
+          if (input.defaultValue !== undefined) input.value = input.defaultValue;
+        });
+      });
+    });
+  }
+
+  bindForms(document);
+  connect();
+})();
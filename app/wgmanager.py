@@ -1,30 +1,120 @@
 # app/wgmanager.py
 import argparse
 import sys
-from . import crud, wireguard
+from datetime import datetime
+from . import backup, crud, wireguard
+
+def _mesh_id(args, default=crud.DEFAULT_MESH_ID):
+    """
+    Resolves the '--mesh' option to a mesh ID.
+    Arguments:
+        args : Command-line arguments containing 'mesh' (mesh name or None).
+        default : Value returned when '--mesh' is not given.
+    Returns:
+        int : ID of the mesh (or default).
+    Raises:
+        SystemExit : If the mesh does not exist.
+    """
+    if args.mesh is None:
+        return default
+    mesh = crud.get_mesh_by_name(args.mesh)
+    if not mesh:
+        print(f"No mesh named {args.mesh}", file=sys.stderr)
+        raise SystemExit(2)
+    return mesh["id"]
+
+def _non_negative_int(value):
+    """
+    Argument type accepting integers greater than or equal to zero.
+    Arguments:
+        value : Raw command-line value.
+    Returns:
+        int : Parsed value.
+    Raises:
+        argparse.ArgumentTypeError : If the value is not a non-negative integer.
+    """
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer: {value}")
+    if n < 0:
+        raise argparse.ArgumentTypeError(f"must be >= 0: {value}")
+    return n
+
+def _positive_int(value):
+    """
+    Argument type accepting integers greater than zero.
+    Arguments:
+        value : Raw command-line value.
+    Returns:
+        int : Parsed value.
+    Raises:
+        argparse.ArgumentTypeError : If the value is not a positive integer.
+    """
+    n = _non_negative_int(value)
+    if n == 0:
+        raise argparse.ArgumentTypeError(f"must be > 0: {value}")
+    return n
+
+# Command to list all meshes
+def cmd_list_meshes(args):
+    """
+    Lists all meshes stored in the database.
+    Arguments:
+        args : Command-line arguments (not used here).
+    Returns:
+        None
+    """
+    for m in crud.list_meshes():
+        try:
+            out = wireguard.mesh_output_dir(m)
+        except ValueError:
+            out = "(invalid)"
+        print(f"{m['id']:>3}  {m['name']:<20}  subnet={m['subnet'] or '-':<18}  port={m['default_port'] or '-'}  "
+              f"mtu={m['default_mtu'] or '-'}  out={out}")
+
+def cmd_add_mesh(args):
+    """
+    Adds a new mesh.
+    Arguments:
+        args : Command-line arguments containing 'name', 'subnet', 'port', 'mtu' and 'output_dir'.
+    Returns:
+        int : Exit code (0 for success, 2 for failure).
+    """
+    if crud.get_mesh_by_name(args.name):
+        print(f"Mesh {args.name} already exists", file=sys.stderr)
+        return 2
+    try:
+        mesh_id = wireguard.create_mesh(args.name, args.subnet, default_port=args.port,
+                                        default_mtu=args.mtu, output_dir=args.output_dir)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(f"Created mesh {args.name} (id={mesh_id})")
+    return 0
 
 # Command to list all nodes
 def cmd_list_nodes(args):
     """
-    Lists all nodes stored in the database.
+    Lists all nodes of a mesh stored in the database.
     Arguments:
-        args : Command-line arguments (not used here).
+        args : Command-line arguments containing 'mesh' (optional mesh name).
     Returns:
         None
     """
-    rows = crud.list_nodes()
+    rows = crud.list_nodes(_mesh_id(args))
     for r in rows:
         print(f"{r[0]:>3}  {r[1]:<20}  public={r[2] or '-':<16}  vpn={r[3] or '-':<14}  port={r[4] or '-'}  mtu={r[5] or '-'}")
 
 def cmd_list_users(args):
     """
-    Lists all users stored in the database.
+    Lists all users of a mesh stored in the database.
     Arguments:
-        args : Command-line arguments (not used here).
+        args : Command-line arguments containing 'mesh' (optional mesh name).
     Returns:
         None
     """    
-    rows = crud.list_users()
+    rows = crud.list_users(_mesh_id(args))
     for r in rows:
         print(f"{r[0]:>3}  {r[1]:<20}  vpn={r[2] or '-':<14}  mtu={r[3] or '-'}")
 
@@ -38,11 +128,11 @@ def cmd_update_ip(args):
     """    
     name = args.name
     ip = args.ip
-    node = crud.get_node_by_name(name)
+    node = crud.get_node_by_name(name, _mesh_id(args))
     if not node:
         print(f"No node named {name}", file=sys.stderr)
         return 2
-    crud.update_node_ip(node[0], ip)
+    crud.update_node_public_ip(node["id"], ip)
     print(f"Updated {name} public_ip -> {ip}")
     return 0
 
@@ -56,29 +146,98 @@ def cmd_update_vpn(args):
     """    
     name = args.name
     vpn = args.vpn
-    node = crud.get_node_by_name(name)
-    if node:
-        crud.update_node_vpn_ip(node[0], vpn)
-        print(f"Updated node {name} vpn_ip -> {vpn}")
-        return 0
-    user = crud.get_user_by_name(name)
-    if user:
-        crud.update_user_vpn_ip(user[0], vpn)
-        print(f"Updated user {name} vpn_ip -> {vpn}")
-        return 0
-    print(f"No node or user named {name}", file=sys.stderr)
-    return 2
+    mesh_id = _mesh_id(args)
+    node = crud.get_node_by_name(name, mesh_id)
+    user = None if node else crud.get_user_by_name(name, mesh_id)
+    if not node and not user:
+        print(f"No node or user named {name}", file=sys.stderr)
+        return 2
+    try:
+        if node:
+            crud.update_node_vpn_ip(node["id"], vpn)
+        else:
+            crud.update_user_vpn_ip(user["id"], vpn)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(f"Updated {'node' if node else 'user'} {name} vpn_ip -> {vpn}")
+    return 0
 
 def cmd_genmesh(args):
     """
-    Generates WireGuard configuration files for all nodes and users.
+    Generates WireGuard configuration files for all nodes and users,
+    of one mesh or of every mesh in parallel.
     Arguments:
-        args : Command-line arguments (not used here).
+        args : Command-line arguments containing 'mesh' (optional mesh name) and 'workers'.
     Returns:
-        int : Exit code (0 for success).
+        int : Exit code (0 for success, 1 if a mesh failed).
     """    
-    wireguard.generate_configs()
-    print("Configs generated in ./data/wireguard_config")
+    mesh_id = _mesh_id(args, default=None)
+    mesh_ids = None if mesh_id is None else [mesh_id]
+    results = wireguard.generate_all_meshes(mesh_ids, workers=args.workers)
+    code = 0
+    for mid in sorted(results):
+        res = results[mid]
+        print(f"[mesh {mid}] {res['status']}: {res['msg']}")
+        if res["status"] != "ok":
+            code = 1
+    return code
+
+def cmd_rotate_keys(args):
+    """
+    Rotates the keypairs of the selected nodes and users and regenerates the affected configs.
+    Arguments:
+        args : Command-line arguments containing the selector ('all', 'stale_days' or 'names'),
+               'batch_size' and 'workers'.
+    Returns:
+        int : Exit code (0 for success, 1 for an interrupted rotation, 2 for invalid arguments).
+    """
+    names = None
+    if args.names:
+        names = [n.strip() for n in args.names.split(",") if n.strip()]
+        if not names:
+            print("No name given", file=sys.stderr)
+            return 2
+    res = wireguard.rotate_keys(names=names, stale_days=args.stale_days, mesh_id=_mesh_id(args, default=None),
+                                batch_size=args.batch_size, workers=args.workers)
+    if res["status"] == "no-match":
+        print("No node or user matched the given names", file=sys.stderr)
+        return 2
+    if res["status"] == "error":
+        print(f"Rotation interrupted: {res['msg']}", file=sys.stderr)
+        print(f"Rotated keys: {res['nodes']} node(s), {res['users']} user(s)")
+        return 1
+    print(f"Rotated keys: {res['nodes']} node(s), {res['users']} user(s)")
+    return 0
+
+def cmd_backup(args):
+    """
+    Writes a gzip-compressed snapshot of the database, without blocking the running application.
+    Arguments:
+        args : Command-line arguments containing 'output' (backup file path).
+    Returns:
+        int : Exit code (0 for success).
+    """
+    output = args.output or f"wireguard-{datetime.now():%Y%m%d-%H%M%S}.db.gz"
+    backup.write_backup(output)
+    print(f"Backup written to {output}")
+    return 0
+
+def cmd_restore(args):
+    """
+    Replaces the database with a snapshot, after checking its integrity.
+    Arguments:
+        args : Command-line arguments containing 'input' (backup file path).
+    Returns:
+        int : Exit code (0 for success, 2 for failure).
+    """
+    try:
+        with open(args.input, "rb") as f:
+            backup.restore(f)
+    except (OSError, ValueError) as e:
+        print(f"Restore failed: {e}", file=sys.stderr)
+        return 2
+    print(f"Database restored from {args.input}")
     return 0
 
 def main():
@@ -89,8 +248,22 @@ def main():
         int : Exit code (0 for success, 1 for invalid command).
     """    
     parser = argparse.ArgumentParser(prog="wgmanager", description="WG Manager CLI")
+    parser.add_argument("--mesh", help="Mesh name (default mesh, or every mesh for genmesh/rotate-keys)")
     sub = parser.add_subparsers(dest="cmd")
 
+    # Subcommand to list meshes
+    p = sub.add_parser("list-meshes")
+    p.set_defaults(func=cmd_list_meshes)
+
+    # Subcommand to add a mesh
+    p = sub.add_parser("add-mesh")
+    p.add_argument("--name", required=True)
+    p.add_argument("--subnet", required=True, help="VPN subnet of the mesh, e.g. 10.200.0.0/24")
+    p.add_argument("--port", type=int, default=51820)
+    p.add_argument("--mtu", type=int, default=1420)
+    p.add_argument("--output-dir", help=f"Sub-directory of {wireguard.OUTPUT_DIR} (default: <name>)")
+    p.set_defaults(func=cmd_add_mesh)
+
     # Subcommand to list nodes
     p = sub.add_parser("list-nodes")
     p.set_defaults(func=cmd_list_nodes)
@@ -113,13 +286,35 @@ def main():
 
     # Subcommand to generate WireGuard configuration files
     p = sub.add_parser("genmesh")
+    p.add_argument("--workers", type=int, default=wireguard.MESH_WORKERS)
     p.set_defaults(func=cmd_genmesh)
 
+    # Subcommand to rotate the keys of nodes and users
+    p = sub.add_parser("rotate-keys")
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument("--all", action="store_true")
+    g.add_argument("--stale-days", type=_non_negative_int)
+    g.add_argument("--names", help="Comma-separated list of node/user names")
+    p.add_argument("--batch-size", type=_positive_int, default=wireguard.ROTATION_BATCH_SIZE)
+    p.add_argument("--workers", type=_positive_int, default=wireguard.ROTATION_WORKERS)
+    p.set_defaults(func=cmd_rotate_keys)
+
+    # Subcommand to back up the database
+    p = sub.add_parser("backup")
+    p.add_argument("--output", help="Backup file (default: wireguard-<date>.db.gz)")
+    p.set_defaults(func=cmd_backup)
+
+    # Subcommand to restore the database from a backup
+    p = sub.add_parser("restore")
+    p.add_argument("--input", required=True)
+    p.set_defaults(func=cmd_restore)
+
     # Parse arguments and execute the corresponding command
     args = parser.parse_args()
     if not hasattr(args, "func"):
         parser.print_help()
         return 1
+    crud.init_db()  # Create or migrate the schema shared with the web app
     return args.func(args)
 
 # Entry point for the script
@@ -1,11 +1,112 @@
+import ipaddress
+import multiprocessing
+import os
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from app import crud  # ✅ IMPORT PACKAGÉ
+from app.events import publish
 
 # Directory to store generated WireGuard configuration files
 OUTPUT_DIR = "/data/wireguard_config"
 Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
 
+# Number of keypairs written to the database per transaction during a rotation
+ROTATION_BATCH_SIZE = 500
+
+# Number of workers spawning 'wg genkey' / 'wg pubkey' in parallel
+ROTATION_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Maximum number of meshes generated in parallel (one process per mesh)
+MESH_WORKERS = os.cpu_count() or 1
+
+# Number of config files written between two 'genmesh' progress events
+PROGRESS_EVERY = 100
+
+# Config files written by generate_configs(), the only files ever deleted from an output directory
+GENERATED_CONFIGS = ("node-*.conf", "user-*.conf")
+
+def mesh_output_dir(mesh):
+    """
+    Returns the directory where the configs of a mesh are written.
+    The default mesh uses OUTPUT_DIR, other meshes a sub-directory named after them,
+    unless the mesh defines its own 'output_dir' (always inside OUTPUT_DIR).
+    Arguments:
+        mesh : Mesh row.
+    Returns:
+        Path : Output directory of the mesh.
+    Raises:
+        ValueError : If the stored 'output_dir' points outside OUTPUT_DIR.
+    """
+    if mesh["output_dir"]:
+        path = Path(mesh["output_dir"]).resolve()
+        if Path(OUTPUT_DIR).resolve() not in path.parents:
+            raise ValueError(f"Output directory outside {OUTPUT_DIR}: {mesh['output_dir']}")
+        return path
+    if mesh["id"] == crud.DEFAULT_MESH_ID:
+        return Path(OUTPUT_DIR)
+    return Path(OUTPUT_DIR, mesh["name"])
+
+def resolve_output_dir(name, output_dir=None):
+    """
+    Resolves and checks the output directory of a new mesh.
+    Relative paths are taken from OUTPUT_DIR. The directory must be a sub-directory of OUTPUT_DIR
+    and must not be used by another mesh, whose configs would otherwise be overwritten or cleared.
+    Arguments:
+        name : Name of the new mesh.
+        output_dir : Requested directory (default: OUTPUT_DIR/<name>).
+    Returns:
+        str : Absolute path of the directory, or None if output_dir is not given.
+    Raises:
+        ValueError : If the directory is outside OUTPUT_DIR or already used by another mesh.
+    """
+    base = Path(OUTPUT_DIR).resolve()
+    path = Path(base, output_dir or name).resolve()
+    if base not in path.parents:
+        raise ValueError(f"Output directory must be a sub-directory of {OUTPUT_DIR}: {output_dir or name}")
+    for m in crud.list_meshes():
+        try:
+            used = mesh_output_dir(m).resolve()
+        except ValueError:
+            continue
+        if used == path:
+            raise ValueError(f"Output directory already used by mesh {m['name']}: {path}")
+    return str(path) if output_dir else None
+
+def create_mesh(name, subnet, default_port=51820, default_mtu=1420, output_dir=None):
+    """
+    Adds a new mesh after checking its output directory (see resolve_output_dir()).
+    Arguments:
+        name : Unique name of the mesh (letters, digits, '-' and '_').
+        subnet : VPN subnet of the mesh (e.g. 10.200.0.0/24).
+        default_port : Port used by nodes without an explicit port.
+        default_mtu : MTU used by nodes and users without an explicit MTU.
+        output_dir : Optional directory for the generated configs, inside OUTPUT_DIR.
+    Returns:
+        int : ID of the new mesh.
+    Raises:
+        ValueError : If the name or the output directory is invalid.
+    """
+    if not crud.MESH_NAME_RE.match(name or ""):
+        raise ValueError(f"Invalid mesh name: {name!r}")
+    return crud.create_mesh(name, subnet, default_port=default_port, default_mtu=default_mtu,
+                            output_dir=resolve_output_dir(name, output_dir))
+
+def clear_configs(out_dir):
+    """
+    Deletes the config files generated in a directory. Any other file is left untouched.
+    Arguments:
+        out_dir : Output directory of a mesh.
+    """
+    out_dir = Path(out_dir)
+    if not out_dir.is_dir():
+        return
+    for pattern in GENERATED_CONFIGS:
+        for p in out_dir.glob(pattern):
+            if p.is_file():
+                try: p.unlink()
+                except Exception: pass
+
 def gen_keypair():
     """
     Generates a WireGuard key pair (private and public keys).
@@ -18,26 +119,93 @@ def gen_keypair():
     public  = subprocess.check_output(["wg", "pubkey"], input=private.encode()).decode().strip()
     return private, public
 
-def ensure_keys():
+def ensure_keys(mesh_id=None):
     """
     Ensures that all nodes and users have private and public keys.
     If keys are missing, they are generated and stored in the database.
+    Arguments:
+        mesh_id : Optional mesh to restrict the check to.
     """
-    # Generate keys for nodes if missing    
-    for n in crud.list_nodes():
-        if not n["private_key"] or not n["public_key"]:
-            priv, pub = gen_keypair()
-            conn = crud.get_conn()
-            conn.execute("UPDATE nodes SET private_key=?, public_key=? WHERE id=?", (priv, pub, n["id"]))
-            conn.commit(); conn.close()
-
-    # Generate keys for users if missing    
-    for u in crud.list_users():
-        if not u["private_key"] or not u["public_key"]:
-            priv, pub = gen_keypair()
-            conn = crud.get_conn()
-            conn.execute("UPDATE users SET private_key=?, public_key=? WHERE id=?", (priv, pub, u["id"]))
-            conn.commit(); conn.close()
+    for kind, rows in (("node", crud.list_nodes(mesh_id, with_private_keys=True)),
+                       ("user", crud.list_users(mesh_id, with_private_keys=True))):
+        missing = [r for r in rows if not r["private_key"] or not r["public_key"]]
+        if missing:
+            _store_new_keys(kind, missing)
+
+def _store_new_keys(kind, peers, batch_size=ROTATION_BATCH_SIZE, workers=ROTATION_WORKERS, stored=None):
+    """
+    Generates new keypairs for the given peers on a worker pool and stores them batch by batch.
+    Each batch is written in its own short transaction, so the database is never locked for long.
+    Arguments:
+        kind : "node" or "user".
+        peers : Rows with at least 'id' and 'public_key'.
+        batch_size : Number of keypairs written per transaction.
+        workers : Number of parallel key generators.
+        stored : Optional list extended with the peers of each committed batch,
+                 so callers know what was written if a later batch fails.
+    """
+    if not peers:
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i in range(0, len(peers), batch_size):
+            batch = peers[i:i + batch_size]
+            pairs = pool.map(lambda _: gen_keypair(), batch)
+            keys = [(p["id"], p["public_key"], priv, pub) for p, (priv, pub) in zip(batch, pairs)]
+            crud.store_keys(kind, keys)
+            if stored is not None:
+                stored.extend(batch)
+
+def rotate_keys(names=None, stale_days=None, mesh_id=None,
+                batch_size=ROTATION_BATCH_SIZE, workers=ROTATION_WORKERS):
+    """
+    Rotates the keypairs of the selected nodes and users, then regenerates the affected configs.
+    Selection: every peer by default, only the given names, or only keys older than stale_days.
+    Regeneration:
+        - node configs reference every peer, they are always rewritten
+        - user configs reference nodes only, they are rewritten for rotated users,
+          or for all users if a node was rotated
+    Arguments:
+        names : Optional list of node/user names.
+        stale_days : Optional key age (in days) after which a key is rotated.
+        mesh_id : Optional mesh to restrict the rotation to (all meshes by default).
+        batch_size : Number of keypairs written per transaction.
+        workers : Number of parallel key generators.
+    Returns:
+        dict : Status ("ok", "no-match" when names select no peer, or "error" when the rotation
+               stopped partway), rotated counts and message. On error, the counts are those
+               of the committed batches, whose configs are regenerated all the same.
+    Raises:
+        ValueError : If stale_days is negative.
+    """
+    selected = {kind: crud.list_peers_for_rotation(kind, names=names, stale_days=stale_days, mesh_id=mesh_id)
+                for kind in ("node", "user")}
+    if names and not (selected["node"] or selected["user"]):
+        return {"status": "no-match", "nodes": 0, "users": 0,
+                "msg": "Aucun nœud ni utilisateur ne correspond aux noms donnés"}
+
+    rotated = {"node": [], "user": []}
+    error = None
+    try:
+        for kind, peers in selected.items():
+            _store_new_keys(kind, peers, batch_size=batch_size, workers=workers, stored=rotated[kind])
+    except Exception as e:
+        error = e
+    finally:
+        # Only the meshes containing rotated peers are regenerated
+        node_meshes = {p["mesh_id"] for p in rotated["node"]}
+        user_ids = {}
+        for p in rotated["user"]:
+            user_ids.setdefault(p["mesh_id"], set()).add(p["id"])
+        for mid in sorted(node_meshes | set(user_ids)):
+            generate_configs(mid, user_ids=None if mid in node_meshes else user_ids[mid])
+
+    msg = f"Clés renouvelées : {len(rotated['node'])} nœud(s), {len(rotated['user'])} utilisateur(s)"
+    return {
+        "status": "ok" if error is None else "error",
+        "nodes": len(rotated["node"]),
+        "users": len(rotated["user"]),
+        "msg": msg if error is None else f"Renouvellement interrompu ({error}). {msg}",
+    }
 
 def _val(row, key, default=None):
     """
@@ -53,6 +221,19 @@ def _val(row, key, default=None):
     v = row.get(key) if hasattr(row, "get") else row[key]
     return v if v not in (None, "") else default
 
+def _host_route(ip):
+    """
+    Returns an address as a single-host network: /32 for IPv4, /128 for IPv6.
+    Arguments:
+        ip : IP address.
+    Returns:
+        str : Address with its host prefix length.
+    """
+    try:
+        return f"{ip}/{ipaddress.ip_address(ip).max_prefixlen}"
+    except ValueError:
+        return f"{ip}/32"
+
 def _append_endpoint_and_keepalive(lines, public_ip, port):
     """
     Appends the 'Endpoint' and 'PersistentKeepalive' configuration to a list of lines.
@@ -66,34 +247,59 @@ def _append_endpoint_and_keepalive(lines, public_ip, port):
     lines.append("PersistentKeepalive = 25")
     lines.append("")
 
-def generate_configs():
+def generate_configs(mesh_id=crud.DEFAULT_MESH_ID, user_ids=None):
     """
-    Generates WireGuard configuration files for nodes and users.
-    Writes 'node-{name}.conf' and 'user-{name}.conf' files to OUTPUT_DIR.
+    Generates WireGuard configuration files for the nodes and users of one mesh.
+    Writes 'node-{name}.conf' and 'user-{name}.conf' files to the output directory of the mesh.
+    Nodes and users without port/MTU use the defaults of the mesh,
+    those without VPN IP are first given a free address of the mesh subnet (stored).
+    When user_ids is given, only the configs of those users are rewritten
+    (node configs are always rewritten since they reference every user).
     Configuration details:
-        - Nodes ↔ Nodes: AllowedIPs = vpn_ip/32
-        - Users → Nodes: AllowedIPs = vpn_ip_node/32 (split tunnel, no full tunnel)
+        - Nodes ↔ Nodes: AllowedIPs = vpn_ip/32 (/128 for IPv6)
+        - Users → Nodes: AllowedIPs = vpn_ip_node/32 (/128 for IPv6; split tunnel, no full tunnel)
         - Endpoint if public_ip + port are available
         - PersistentKeepalive = 25 for all peers
         - No Pre-Shared Keys (PSK)
+    Arguments:
+        mesh_id : ID of the mesh to generate.
+        user_ids : Optional set of user IDs whose config must be rewritten.
     Returns:
         dict : Status and message indicating the result of the operation.
     """
-    ensure_keys()  # Ensure all nodes and users have keys
-    nodes = list(crud.list_nodes())
-    users = list(crud.list_users())
+    mesh = crud.get_mesh(mesh_id)
+    if mesh is None:
+        return {"status": "error", "msg": f"Réseau {mesh_id} introuvable"}
+    try:
+        out_dir = mesh_output_dir(mesh)
+    except ValueError as e:
+        return {"status": "error", "msg": str(e)}
+    out_dir.mkdir(parents=True, exist_ok=True)
+    def_port = _val(mesh, "default_port", 51820)
+    def_mtu  = _val(mesh, "default_mtu", None)
+
+    ensure_keys(mesh_id)  # Ensure all nodes and users have keys
+    try:
+        crud.assign_missing_vpn_ips(mesh_id)  # Entries created without VPN IP by older versions
+    except ValueError as e:
+        return {"status": "error", "msg": str(e)}
+    nodes = list(crud.list_nodes(mesh_id, with_private_keys=True))
+    users = list(crud.list_users(mesh_id, with_private_keys=True))
+    total = len(nodes) + (len(users) if user_ids is None else sum(u["id"] in user_ids for u in users))
+    done = 0
+    publish("genmesh", {"mesh_id": mesh_id, "state": "running", "done": 0, "total": total})
 
     # Generate configurations for nodes
     for n in nodes:
         name   = _val(n, "name", "noname")
-        vpn_ip = _val(n, "vpn_ip", "10.100.10.1")
-        port   = _val(n, "port", 51820)
-        mtu    = _val(n, "mtu", None)
+        vpn_ip = _val(n, "vpn_ip")
+        port   = _val(n, "port", def_port)
+        mtu    = _val(n, "mtu", def_mtu)
         priv   = _val(n, "private_key", "<PRIVATE_KEY>")
 
         lines = [
             "[Interface]",
-            f"Address = {vpn_ip}/32",
+            f"Address = {_host_route(vpn_ip)}",
             f"ListenPort = {port}",
         ]
         if mtu not in (None, ""):
@@ -108,12 +314,12 @@ def generate_configs():
             peer_pub  = _val(peer, "public_key", "<PEER_PUBLIC_KEY>")
             peer_vip  = _val(peer, "vpn_ip", None)
             peer_pip  = _val(peer, "public_ip", None)
-            peer_port = _val(peer, "port", None)
+            peer_port = _val(peer, "port", def_port)
             if peer_vip:
                 lines += [
                     "[Peer]",
                     f"PublicKey = {peer_pub}",
-                    f"AllowedIPs = {peer_vip}/32",
+                    f"AllowedIPs = {_host_route(peer_vip)}",
                 ]
                 _append_endpoint_and_keepalive(lines, peer_pip, peer_port)
 
@@ -125,24 +331,29 @@ def generate_configs():
                 lines += [
                     "[Peer]",
                     f"PublicKey = {u_pub}",
-                    f"AllowedIPs = {u_vip}/32",
+                    f"AllowedIPs = {_host_route(u_vip)}",
                     "PersistentKeepalive = 25",
                     "",
                 ]
         
         # Write node configuration to file
-        Path(OUTPUT_DIR, f"node-{name}.conf").write_text("\n".join(lines).strip() + "\n", encoding="utf-8")
+        Path(out_dir, f"node-{name}.conf").write_text("\n".join(lines).strip() + "\n", encoding="utf-8")
+        done += 1
+        if done % PROGRESS_EVERY == 0:
+            publish("genmesh", {"mesh_id": mesh_id, "state": "running", "done": done, "total": total})
 
     # Generate configurations for users
     for u in users:
+        if user_ids is not None and u["id"] not in user_ids:
+            continue
         name   = _val(u, "name", "client")
-        vpn_ip = _val(u, "vpn_ip", "10.100.10.100")
-        mtu    = _val(u, "mtu", None)
+        vpn_ip = _val(u, "vpn_ip")
+        mtu    = _val(u, "mtu", def_mtu)
         priv   = _val(u, "private_key", "<PRIVATE_KEY>")
 
         lines = [
             "[Interface]",
-            f"Address = {vpn_ip}/32",
+            f"Address = {_host_route(vpn_ip)}",
         ]
         if mtu not in (None, ""):
             lines.append(f"MTU = {mtu}")
@@ -154,14 +365,52 @@ def generate_configs():
             n_pub  = _val(n, "public_key", "<PEER_PUBLIC_KEY>")
             n_vip  = _val(n, "vpn_ip", None)
             n_pip  = _val(n, "public_ip", None)
-            n_port = _val(n, "port", None)
+            n_port = _val(n, "port", def_port)
 
             lines.append("[Peer]")
             lines.append(f"PublicKey = {n_pub}")
-            lines.append(f"AllowedIPs = {n_vip}/32" if n_vip else "AllowedIPs = 0.0.0.0/32")
+            lines.append(f"AllowedIPs = {_host_route(n_vip)}" if n_vip else "AllowedIPs = 0.0.0.0/32")
             _append_endpoint_and_keepalive(lines, n_pip, n_port)
 
         # Write user configuration to file
-        Path(OUTPUT_DIR, f"user-{name}.conf").write_text("\n".join(lines).strip() + "\n", encoding="utf-8")
+        Path(out_dir, f"user-{name}.conf").write_text("\n".join(lines).strip() + "\n", encoding="utf-8")
+        done += 1
+        if done % PROGRESS_EVERY == 0:
+            publish("genmesh", {"mesh_id": mesh_id, "state": "running", "done": done, "total": total})
+
+    publish("genmesh", {"mesh_id": mesh_id, "state": "done", "done": done, "total": total})
+    return {"status": "ok", "msg": f"Configurations générées dans {out_dir}"}
+
+def generate_all_meshes(mesh_ids=None, workers=MESH_WORKERS):
+    """
+    Generates the configs of several meshes in parallel, one process per mesh.
+    Meshes are independent: a slow or failing mesh does not delay nor fail the others.
+    Worker processes cannot reach the SSE subscribers, so a 'genmesh' event is published
+    here as each mesh completes.
+    Arguments:
+        mesh_ids : Optional list of mesh IDs (all meshes by default).
+        workers : Maximum number of meshes generated at the same time.
+    Returns:
+        dict : Result of generate_configs() for each mesh ID.
+    """
+    if mesh_ids is None:
+        mesh_ids = [m["id"] for m in crud.list_meshes()]
+    if len(mesh_ids) <= 1 or workers <= 1:
+        return {mid: generate_configs(mid) for mid in mesh_ids}
 
-    return {"status": "ok", "msg": f"Configurations générées dans {OUTPUT_DIR}"}
+    results = {}
+    # 'spawn' avoids forking the threads of the web server
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(mesh_ids)), mp_context=ctx) as pool:
+        futures = {pool.submit(generate_configs, mid): mid for mid in mesh_ids}
+        for mid in mesh_ids:
+            publish("genmesh", {"mesh_id": mid, "state": "running"})
+        for fut in as_completed(futures):
+            mid = futures[fut]
+            try:
+                results[mid] = fut.result()
+            except Exception as e:
+                results[mid] = {"status": "error", "msg": str(e)}
+            state = "done" if results[mid]["status"] == "ok" else "error"
+            publish("genmesh", {"mesh_id": mid, "state": state})
+    return results
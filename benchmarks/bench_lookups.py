@@ -0,0 +1,82 @@
+# benchmarks/bench_lookups.py
+"""
+Point lookup benchmark: name / vpn_ip / public_key lookups on 1k, 10k and 100k users.
+With the indexes of the schema, the time per lookup should stay flat as the table grows;
+the 'scan' column runs the same query with NOT INDEXED for comparison.
+
+Usage:
+    python -m benchmarks.bench_lookups [sizes...]
+"""
+import base64
+import os
+import sys
+import tempfile
+import time
+
+from app import crud, db
+
+LOOKUPS = 2000
+
+
+def populate(n):
+    """
+    Creates the schema and inserts n users in the default mesh.
+    """
+    crud.init_db()
+    conn = crud.get_conn()
+    with conn:
+        conn.executemany(
+            "INSERT INTO users(mesh_id, name, vpn_ip, mtu, public_key) VALUES (?, ?, ?, ?, ?)",
+            ((db.DEFAULT_MESH_ID, f"user{i}", f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 1420,
+              base64.b64encode(i.to_bytes(32, "big")).decode()) for i in range(n)))
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def timed(fn, keys):
+    """
+    Returns the mean time (in microseconds) of fn(key) over keys.
+    """
+    start = time.perf_counter()
+    for k in keys:
+        fn(k)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def bench(n):
+    step = max(1, n // LOOKUPS)
+    ids = range(0, n, step)
+    names = [f"user{i}" for i in ids]
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in ids]
+    keys = [base64.b64encode(i.to_bytes(32, "big")).decode() for i in ids]
+
+    conn = crud.get_conn()
+
+    def query(sql):
+        return lambda k: conn.execute(sql, (db.DEFAULT_MESH_ID, k) if "mesh_id" in sql else (k,)).fetchone()
+
+    res = {
+        "crud name": timed(lambda k: crud.get_user_by_name(k), names),
+        "name": timed(query("SELECT id FROM users WHERE mesh_id=? AND name=?"), names),
+        "vpn_ip": timed(query("SELECT id FROM users WHERE mesh_id=? AND vpn_ip=?"), ips),
+        "public_key": timed(query("SELECT id FROM users WHERE public_key=?"), keys),
+        # Full scans are slow: a few lookups are enough
+        "scan": timed(query("SELECT id FROM users NOT INDEXED WHERE public_key=?"), keys[:20]),
+    }
+    conn.close()
+    return res
+
+
+def main(sizes):
+    cols = ["crud name", "name", "vpn_ip", "public_key", "scan"]
+    print(f"{'users':>8}  " + "  ".join(f"{c + ' (µs)':>16}" for c in cols))
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as d:
+            db.DB_PATH = os.path.join(d, "bench.db")
+            populate(n)
+            res = bench(n)
+        print(f"{n:>8}  " + "  ".join(f"{res[c]:>16.1f}" for c in cols))
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1_000, 10_000, 100_000])